@@ -33,6 +33,7 @@
 #include "xls/synthesis/server_credentials.h"
 #include "xls/synthesis/synthesis.pb.h"
 #include "xls/synthesis/synthesis_service.grpc.pb.h"
+#include "xls/synthesis/synthesis_server_util.h"
 
 const char kUsage[] = R"(
 Launches a XLS synthesis server which generates OpenROAD metrics JSON via a
@@ -75,6 +76,13 @@ class JsonMetricsSynthesisServiceImpl : public SynthesisService::Service {
     return ::grpc::Status::OK;
   }
 
+  ::grpc::Status CompileStream(
+      ::grpc::ServerContext* server_context,
+      ::grpc::ServerReaderWriter<CompileResponse, CompileRequest>* stream)
+      override {
+    return ServeCompileStream(this, server_context, stream);
+  }
+
   absl::Status RunMetrics(const CompileRequest* request,
                           CompileResponse* result) {
     XLS_ASSIGN_OR_RETURN(TempDirectory temp_dir, TempDirectory::Create());
@@ -147,6 +155,7 @@ void RealMain() {
   ::grpc::ServerBuilder builder;
   std::shared_ptr<::grpc::ServerCredentials> creds = GetServerCredentials();
   builder.AddListeningPort(server_address, creds);
+  ConfigureServerBuilder(&builder);
   builder.RegisterService(&service);
   std::unique_ptr<::grpc::Server> server(builder.BuildAndStart());
   XLS_LOG(INFO) << "Serving on port: " << port;
@@ -16,12 +16,15 @@
 
 import subprocess
 
+import grpc
 import portpicker
 
 from google.protobuf import text_format
 from absl.testing import absltest
 from xls.common import runfiles
+from xls.synthesis import client_credentials
 from xls.synthesis import synthesis_pb2
+from xls.synthesis import synthesis_service_pb2_grpc
 
 CLIENT_PATH = runfiles.get_path('xls/synthesis/synthesis_client_main')
 SERVER_PATH = runfiles.get_path('xls/synthesis/dummy_synthesis_server_main')
@@ -81,6 +84,30 @@ class SynthesisServerTest(absltest.TestCase):
     proc.terminate()
     proc.wait()
 
+  def test_compile_stream(self):
+    port, proc = self._start_server(['--max_frequency_ghz=2.0'])
+
+    requests = [
+        synthesis_pb2.CompileRequest(
+            module_text=VERILOG,
+            top_module_name='main',
+            target_frequency_hz=int(ghz * 1e9)) for ghz in [1.0, 4.0, 1.5]
+    ]
+    with grpc.secure_channel(
+        f'localhost:{port}', client_credentials.get_credentials()) as channel:
+      grpc.channel_ready_future(channel).result()
+      stub = synthesis_service_pb2_grpc.SynthesisServiceStub(channel)
+      responses = list(stub.CompileStream(iter(requests)))
+
+    # One response per request, in request order.
+    self.assertLen(responses, 3)
+    self.assertGreaterEqual(responses[0].slack_ps, 0)
+    self.assertLess(responses[1].slack_ps, 0)
+    self.assertGreaterEqual(responses[2].slack_ps, 0)
+
+    proc.terminate()
+    proc.wait()
+
 
 if __name__ == '__main__':
   absltest.main()
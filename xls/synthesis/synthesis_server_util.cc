@@ -0,0 +1,59 @@
+// Copyright 2021 The XLS Authors
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#include "xls/synthesis/synthesis_server_util.h"
+
+#include "grpc/grpc.h"
+
+namespace xls {
+namespace synthesis {
+namespace {
+
+// Clients may keep their channels alive with HTTP/2 pings while a long
+// synthesis call is in flight (see --keepalive_time_ms in
+// timing_characterization_client.py, which must not be below this). More
+// frequent pings are answered with GOAWAY(too_many_pings), which closes the
+// connection.
+constexpr int kMinClientPingIntervalMs = 10000;
+
+}  // namespace
+
+void ConfigureServerBuilder(::grpc::ServerBuilder* builder) {
+  builder->AddChannelArgument(
+      GRPC_ARG_HTTP2_MIN_RECV_PING_INTERVAL_WITHOUT_DATA_MS,
+      kMinClientPingIntervalMs);
+}
+
+::grpc::Status ServeCompileStream(
+    SynthesisService::Service* service, ::grpc::ServerContext* server_context,
+    ::grpc::ServerReaderWriter<CompileResponse, CompileRequest>* stream) {
+  CompileRequest request;
+  while (stream->Read(&request)) {
+    CompileResponse response;
+    ::grpc::Status status =
+        service->Compile(server_context, &request, &response);
+    if (!status.ok()) {
+      return status;
+    }
+    if (!stream->Write(response)) {
+      // The stream is broken, e.g. because the client went away.
+      return ::grpc::Status(::grpc::StatusCode::UNAVAILABLE,
+                            "Failed to write CompileStream response");
+    }
+  }
+  return ::grpc::Status::OK;
+}
+
+}  // namespace synthesis
+}  // namespace xls
@@ -0,0 +1,39 @@
+// Copyright 2021 The XLS Authors
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//      http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+
+#ifndef XLS_SYNTHESIS_SYNTHESIS_SERVER_UTIL_H_
+#define XLS_SYNTHESIS_SYNTHESIS_SERVER_UTIL_H_
+
+#include "grpcpp/server_builder.h"
+#include "grpcpp/server_context.h"
+#include "grpcpp/support/sync_stream.h"
+#include "xls/synthesis/synthesis.pb.h"
+#include "xls/synthesis/synthesis_service.grpc.pb.h"
+
+namespace xls {
+namespace synthesis {
+
+// Sets the channel arguments shared by the synthesis servers on 'builder'.
+void ConfigureServerBuilder(::grpc::ServerBuilder* builder);
+
+// Implements SynthesisService.CompileStream in terms of service->Compile(),
+// answering each request on 'stream' in order.
+::grpc::Status ServeCompileStream(
+    SynthesisService::Service* service, ::grpc::ServerContext* server_context,
+    ::grpc::ServerReaderWriter<CompileResponse, CompileRequest>* stream);
+
+}  // namespace synthesis
+}  // namespace xls
+
+#endif  // XLS_SYNTHESIS_SYNTHESIS_SERVER_UTIL_H_
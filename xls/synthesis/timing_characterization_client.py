@@ -19,17 +19,29 @@ These datapoints can be used in a delay model (where they will be interpolated)
 format.
 """
 
+import collections
+from concurrent import futures
+import dataclasses
+import functools
+import hashlib
+import math
+import queue
+import sqlite3
+import struct
 import sys
-from typing import Dict, Sequence, Set, Tuple
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
 
 from absl import flags
 from absl import logging
 
+import grpc
+
 from google.protobuf import text_format
 from xls.common import gfile
 from xls.common.file.python import filesystem
 from xls.delay_model import delay_model_pb2
-from xls.delay_model import op_module_generator
 from xls.ir.op_specification import OPS
 from xls.synthesis import synthesis_pb2
 from xls.synthesis import synthesis_service_pb2_grpc
@@ -41,86 +53,553 @@ _MAX_FREQ_MHZ = flags.DEFINE_integer(
     'max_freq_mhz', 5000, 'Maximum frequency to test.')
 _CHECKPOINT_PATH = flags.DEFINE_string(
     'checkpoint_path', '', 'Path at which to load and save checkpoints. ' +
-    'Checkpoints will not be kept if unspecified.')
+    'Data points added since the checkpoint was last rewritten are logged ' +
+    'to this path plus ".log". Checkpoints will not be kept if unspecified.')
+_CHECKPOINT_COMPACTION_INTERVAL = flags.DEFINE_integer(
+    'checkpoint_compaction_interval', 100, 'Number of data points appended ' +
+    'to the checkpoint log between full rewrites of the checkpoint.')
 _SAMPLES_PATH = flags.DEFINE_string(
     'samples_path', '', 'Path at which to load samples textproto.')
-
-ENUM2NAME_MAP = dict((op.enum_name, op.name) for op in OPS)
+_MAX_WORKERS = flags.DEFINE_integer(
+    'max_workers', 1, 'Number of op parameterizations to characterize ' +
+    'concurrently. The synthesis server must support concurrent requests.',
+    lower_bound=1)
+_USE_COMPILE_STREAM = flags.DEFINE_bool(
+    'use_compile_stream', False, 'Send compile requests over one long-lived ' +
+    'CompileStream RPC per worker instead of one Compile RPC per request.')
+_PROBES_PER_ROUND = flags.DEFINE_integer(
+    'probes_per_round', 1, 'Number of frequencies to probe concurrently in ' +
+    'each round of the fmax search; 1 is plain bisection.', lower_bound=1)
+_COMPILE_TIMEOUT_S = flags.DEFINE_float(
+    'compile_timeout_s', 0, 'Deadline in seconds for each Compile RPC; ' +
+    '0 means no deadline.')
+_KEEPALIVE_TIME_MS = flags.DEFINE_integer(
+    'keepalive_time_ms', 0, 'Interval in milliseconds between HTTP/2 ' +
+    'keepalive pings on the channel to the synthesis server; 0 disables ' +
+    'them. The server must accept pings this often while a call is in ' +
+    'flight. The servers in xls/synthesis accept one every 10s, but gRPC ' +
+    'servers by default close the connection on pings more often than ' +
+    'every 5 minutes.', lower_bound=0)
+_COMPILE_CACHE_PATH = flags.DEFINE_string(
+    'compile_cache_path', '', 'Path of a sqlite database in which to cache ' +
+    'compile responses across runs. Only reuse it with the same synthesis ' +
+    'server configuration. Responses are cached in memory if unspecified.')
+
+# Maps an op's enum name (e.g. 'kAdd', as in OpSamples.op) to its IR name.
+ENUM2NAME_MAP: Dict[str, str] = dict((op.enum_name, op.name) for op in OPS)
+
+_TOP_MODULE_NAME = 'top'
+
+# (result bit count, operand bit counts, specialization) of a data point.
+_DataPointKey = Tuple[int, Tuple[int, ...], int]
+
+
+def _set_delay_offset(results: delay_model_pb2.DataPoints, minimum_delay: int):
+  logging.vlog(0, f'USING DELAY_OFFSET {minimum_delay}')
+  for dp in results.data_points:
+    dp.delay_offset = minimum_delay
 
 
 def check_delay_offset(results: delay_model_pb2.DataPoints):
   # find the minimum nonzero delay, presumably from a reg-->reg connection
   minimum_delay = min([x.delay for x in results.data_points if x.delay])
-  logging.vlog(0, f'USING DELAY_OFFSET {minimum_delay}')
-  for dp in results.data_points:
-    dp.delay_offset = minimum_delay
+  _set_delay_offset(results, minimum_delay)
+
+
+# First line of a checkpoint written by _write_checkpoint(), followed by the
+# hex ID of its snapshot; a textproto comment, so it does not affect parsing.
+_SNAPSHOT_ID_COMMENT = '# snapshot: '
+_SNAPSHOT_ID_SIZE = 16
+
+
+def _checkpoint_log_path(checkpoint_path: str) -> str:
+  return checkpoint_path + '.log'
+
+
+def _write_checkpoint(results: delay_model_pb2.DataPoints,
+                      checkpoint_path: str) -> bytes:
+  """Writes 'results' as a new snapshot, clears its log and returns its ID."""
+  snapshot_id = uuid.uuid4().bytes
+  with gfile.open(checkpoint_path, 'w') as f:
+    f.write(_SNAPSHOT_ID_COMMENT + snapshot_id.hex() + '\n')
+    f.write(text_format.MessageToString(results))
+  log_path = _checkpoint_log_path(checkpoint_path)
+  if gfile.exists(log_path):
+    gfile.remove(log_path)
+  return snapshot_id
+
+
+def _read_snapshot_id(checkpoint_path: str) -> Optional[bytes]:
+  """Returns the ID _write_checkpoint() gave the checkpoint, if any."""
+  with gfile.open(checkpoint_path, 'r') as f:
+    first_line = f.readline()
+  if not first_line.startswith(_SNAPSHOT_ID_COMMENT):
+    return None
+  return bytes.fromhex(first_line[len(_SNAPSHOT_ID_COMMENT):].strip())
 
 
 def save_checkpoint(results: delay_model_pb2.DataPoints, checkpoint_path: str):
+  """Writes all of 'results' to the checkpoint and clears its log."""
   if checkpoint_path:
     check_delay_offset(results)
-    with gfile.open(checkpoint_path, 'w') as f:
-      f.write(text_format.MessageToString(results))
+    _write_checkpoint(results, checkpoint_path)
+
+
+def _start_checkpoint_log(checkpoint_path: str, snapshot_id: bytes) -> None:
+  """Starts a new log extending the checkpoint snapshot 'snapshot_id'.
+
+  The log begins with the snapshot's ID, so that a log left next to a
+  checkpoint which was since replaced (e.g. emptied to start over) is not
+  replayed on top of it. Length-prefixed DataPoint records follow.
+  """
+  with gfile.open(_checkpoint_log_path(checkpoint_path), 'wb') as f:
+    f.write(snapshot_id)
+
+
+def _append_to_checkpoint_log(data_point: delay_model_pb2.DataPoint,
+                              checkpoint_path: str) -> None:
+  serialized = data_point.SerializeToString()
+  with gfile.open(_checkpoint_log_path(checkpoint_path), 'ab') as f:
+    f.write(struct.pack('<I', len(serialized)) + serialized)
+
+
+def _read_checkpoint_log(
+    checkpoint_path: str) -> List[delay_model_pb2.DataPoint]:
+  """Returns the data points logged since the checkpoint was last written."""
+  log_path = _checkpoint_log_path(checkpoint_path)
+  if not gfile.exists(log_path):
+    return []
+  with gfile.open(log_path, 'rb') as f:
+    contents = f.read()
+  offset = _SNAPSHOT_ID_SIZE
+  if contents[:offset] != _read_snapshot_id(checkpoint_path):
+    logging.warning('Ignoring %s, which extends a different checkpoint.',
+                    log_path)
+    return []
+  data_points = []
+  while offset + 4 <= len(contents):
+    (size,) = struct.unpack_from('<I', contents, offset)
+    offset += 4
+    if offset + size > len(contents):
+      # A record cut short by an interrupted write.
+      break
+    data_points.append(
+        delay_model_pb2.DataPoint.FromString(contents[offset:offset + size]))
+    offset += size
+  return data_points
+
+
+class _Checkpointer:
+  """Adds data points to the results and checkpoints them.
+
+  Rewriting the whole checkpoint after every data point is quadratic in the
+  number of data points, so each new data point is only appended to a log.
+  The full checkpoint is rewritten every 'compaction_interval' data points and
+  by compact(); init_data() replays the log on top of the last full
+  checkpoint. New data points are likewise buffered and only added to the
+  results proto in batches, on compaction.
+
+  The delay offset (the minimum nonzero delay) is kept as a running minimum;
+  the offsets of all data points are only rewritten when it drops.
+
+  'results' must be as loaded by init_data(checkpoint_path), since they are
+  written to the checkpoint as a new snapshot on construction. This also folds
+  in any log left by a previous run.
+  """
+
+  def __init__(self, results: delay_model_pb2.DataPoints, checkpoint_path: str,
+               compaction_interval: int):
+    self._results = results
+    self._checkpoint_path = checkpoint_path
+    self._compaction_interval = compaction_interval
+    self._pending: List[delay_model_pb2.DataPoint] = []
+    self._num_logged = 0
+    self._min_nonzero_delay = 0
+    self._snapshot_id = b''
+    if checkpoint_path:
+      self._min_nonzero_delay = min(
+          (dp.delay for dp in results.data_points if dp.delay), default=0)
+      if self._min_nonzero_delay:
+        # Data points replayed from the log may predate the current minimum.
+        _set_delay_offset(results, self._min_nonzero_delay)
+      # Start a fresh log, rather than append to one which may end in a record
+      # torn by an interrupted write and so misalign the records after it on
+      # the next replay.
+      self._snapshot_id = _write_checkpoint(results, checkpoint_path)
+
+  def add(self, data_point: delay_model_pb2.DataPoint) -> None:
+    """Adds 'data_point' to the results and checkpoints it."""
+    if not self._checkpoint_path:
+      self._pending.append(data_point)
+      return
+    new_minimum = data_point.delay and (
+        not self._min_nonzero_delay or
+        data_point.delay < self._min_nonzero_delay)
+    if new_minimum:
+      self._min_nonzero_delay = data_point.delay
+    # Set before the data point is copied into the results or logged.
+    data_point.delay_offset = self._min_nonzero_delay
+    self._pending.append(data_point)
+    if new_minimum:
+      self._flush()
+      _set_delay_offset(self._results, self._min_nonzero_delay)
+    if not self._num_logged:
+      _start_checkpoint_log(self._checkpoint_path, self._snapshot_id)
+    _append_to_checkpoint_log(data_point, self._checkpoint_path)
+    self._num_logged += 1
+    if self._num_logged >= self._compaction_interval:
+      self.compact()
+
+  def _flush(self) -> None:
+    if self._pending:
+      self._results.data_points.extend(self._pending)
+      self._pending.clear()
+
+  def compact(self) -> None:
+    """Adds all pending data points to the results and checkpoints them."""
+    self._flush()
+    if self._num_logged:
+      self._snapshot_id = _write_checkpoint(self._results,
+                                            self._checkpoint_path)
+      self._num_logged = 0
+
+
+class _CompileStream:
+  """A long-lived CompileStream RPC owned by a single thread.
+
+  The server answers each request with exactly one response, in request order,
+  so a response is matched to its request by its position in the stream.
+  """
+
+  def __init__(self, stub: synthesis_service_pb2_grpc.SynthesisServiceStub):
+    self._requests = queue.Queue()
+    self._responses = stub.CompileStream(
+        iter(self._requests.get, None), compression=grpc.Compression.Gzip)
+
+  def send(self, request: synthesis_pb2.CompileRequest) -> None:
+    self._requests.put(request)
+
+  def receive(self) -> synthesis_pb2.CompileResponse:
+    return next(self._responses)
+
+  def compile(
+      self, request: synthesis_pb2.CompileRequest
+  ) -> synthesis_pb2.CompileResponse:
+    self.send(request)
+    return self.receive()
+
+  def close(self) -> None:
+    self._requests.put(None)
+
+
+class _StreamingStub:
+  """Stand-in for SynthesisServiceStub which compiles over CompileStream.
+
+  Each calling thread gets its own streams, so concurrent workers never
+  interleave requests on one stream. The server compiles the requests on a
+  stream one after another, so requests compiled together go out on separate
+  streams.
+  """
+
+  def __init__(self, stub: synthesis_service_pb2_grpc.SynthesisServiceStub):
+    self._stub = stub
+    self._local = threading.local()
+    self._lock = threading.Lock()
+    self._streams: List[_CompileStream] = []
+
+  def _get_streams(self, count: int) -> List[_CompileStream]:
+    """Returns 'count' of this thread's streams, opening more as needed."""
+    streams = getattr(self._local, 'streams', None)
+    if streams is None:
+      streams = []
+      self._local.streams = streams
+    while len(streams) < count:
+      stream = _CompileStream(self._stub)
+      streams.append(stream)
+      with self._lock:
+        self._streams.append(stream)
+    return streams[:count]
+
+  def Compile(  # pylint: disable=invalid-name
+      self, request: synthesis_pb2.CompileRequest
+  ) -> synthesis_pb2.CompileResponse:
+    return self._get_streams(1)[0].compile(request)
+
+  def compile_all(
+      self, requests: Sequence[synthesis_pb2.CompileRequest]
+  ) -> List[synthesis_pb2.CompileResponse]:
+    """Compiles 'requests' concurrently, each on its own stream."""
+    streams = self._get_streams(len(requests))
+    for stream, request in zip(streams, requests):
+      stream.send(request)
+    return [stream.receive() for stream in streams]
+
+  def close(self) -> None:
+    with self._lock:
+      for stream in self._streams:
+        stream.close()
+      self._streams.clear()
+
+
+class _CachingStub:
+  """Stand-in for SynthesisServiceStub which memoizes compile responses.
+
+  Responses are keyed by the top module name, module text and target
+  frequency. The most recently used responses are kept in memory; if a cache
+  path is given, every response is also stored in a sqlite database there so
+  that later runs can reuse it.
+
+  Only the slack and max frequency of a response are kept, and only those are
+  returned: the netlist and other reports can be many megabytes each.
+  """
+
+  def __init__(self,
+               stub: Union[synthesis_service_pb2_grpc.SynthesisServiceStub,
+                           _StreamingStub],
+               cache_path: str,
+               max_memory_entries: int = 1024):
+    self._stub = stub
+    self._lock = threading.Lock()
+    self._memory = collections.OrderedDict()
+    self._max_memory_entries = max_memory_entries
+    self._db = None
+    if cache_path:
+      self._db = sqlite3.connect(cache_path, check_same_thread=False)
+      self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                       '(key BLOB PRIMARY KEY, response BLOB)')
+      self._db.commit()
+
+  @staticmethod
+  def _key(request: synthesis_pb2.CompileRequest) -> bytes:
+    h = hashlib.sha256()
+    h.update(request.top_module_name.encode())
+    h.update(b'\0')
+    h.update(request.module_text.encode())
+    return h.digest() + request.target_frequency_hz.to_bytes(8, 'little')
+
+  def _get(self, key: bytes) -> Optional[synthesis_pb2.CompileResponse]:
+    with self._lock:
+      serialized = self._memory.get(key)
+      if serialized is not None:
+        self._memory.move_to_end(key)
+      elif self._db is not None:
+        row = self._db.execute('SELECT response FROM responses WHERE key = ?',
+                               (key,)).fetchone()
+        if row is not None:
+          serialized = row[0]
+          self._remember(key, serialized)
+    if serialized is None:
+      return None
+    return synthesis_pb2.CompileResponse.FromString(serialized)
+
+  def _put(self, key: bytes, response: synthesis_pb2.CompileResponse) -> None:
+    serialized = response.SerializeToString()
+    with self._lock:
+      self._remember(key, serialized)
+      if self._db is not None:
+        self._db.execute(
+            'INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)',
+            (key, serialized))
+        self._db.commit()
+
+  def _remember(self, key: bytes, serialized: bytes) -> None:
+    self._memory[key] = serialized
+    self._memory.move_to_end(key)
+    if len(self._memory) > self._max_memory_entries:
+      self._memory.popitem(last=False)
+
+  def Compile(  # pylint: disable=invalid-name
+      self, request: synthesis_pb2.CompileRequest
+  ) -> synthesis_pb2.CompileResponse:
+    return self.compile_all([request])[0]
+
+  def compile_all(
+      self, requests: Sequence[synthesis_pb2.CompileRequest]
+  ) -> List[synthesis_pb2.CompileResponse]:
+    """Answers 'requests' from the cache, compiling only the misses."""
+    keys = [self._key(request) for request in requests]
+    responses = [self._get(key) for key in keys]
+    misses = [i for i, response in enumerate(responses) if response is None]
+    if misses:
+      miss_responses = _compile_all(self._stub, [requests[i] for i in misses])
+      for i, response in zip(misses, miss_responses):
+        response = synthesis_pb2.CompileResponse(
+            slack_ps=response.slack_ps,
+            max_frequency_hz=response.max_frequency_hz)
+        self._put(keys[i], response)
+        responses[i] = response
+    return responses
+
+  def close(self) -> None:
+    if isinstance(self._stub, _StreamingStub):
+      self._stub.close()
+    if self._db is not None:
+      self._db.close()
+
+
+_Stub = Union[synthesis_service_pb2_grpc.SynthesisServiceStub, _StreamingStub,
+              _CachingStub]
+
+
+def _channel_options() -> List[Tuple[str, int]]:
+  """Returns the arguments for the channel to the synthesis service."""
+  # Netlists in responses can exceed gRPC's default 4MiB message limit.
+  options = [('grpc.max_receive_message_length', 64 << 20)]
+  if _KEEPALIVE_TIME_MS.value:
+    # A dead connection is then detected after keepalive_time_ms +
+    # keepalive_timeout_ms, rather than only when the call in flight times out.
+    options += [
+        ('grpc.keepalive_time_ms', _KEEPALIVE_TIME_MS.value),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
+  return options
+
+
+def make_channel(target: str,
+                 credentials: grpc.ChannelCredentials) -> grpc.Channel:
+  """Returns a long-lived channel to the synthesis service at target.
+
+  A characterization run makes thousands of calls over hours, all on this one
+  channel. With --keepalive_time_ms it is kept alive with HTTP/2 pings.
+  """
+  return grpc.secure_channel(target, credentials, options=_channel_options())
+
+
+def _unary_call_options() -> Dict[str, Any]:
+  # Module text is keyword-heavy Verilog, which compresses well.
+  return {
+      'compression': grpc.Compression.Gzip,
+      'timeout': _COMPILE_TIMEOUT_S.value or None,
+  }
+
+
+def _compile_all(
+    stub: _Stub, requests: Sequence[synthesis_pb2.CompileRequest]
+) -> List[synthesis_pb2.CompileResponse]:
+  """Issues 'requests' concurrently, returning responses in request order.
+
+  Unary requests, like the streams of a _StreamingStub, are all in flight at
+  once on the stub's channel, which multiplexes them over a single connection.
+  """
+  if isinstance(stub, (_StreamingStub, _CachingStub)):
+    return stub.compile_all(requests)
+  call_options = _unary_call_options()
+  if len(requests) == 1:
+    return [stub.Compile(requests[0], **call_options)]
+  rpc_futures = [
+      stub.Compile.future(request, **call_options) for request in requests
+  ]
+  try:
+    return [rpc_future.result() for rpc_future in rpc_futures]
+  except BaseException:
+    for rpc_future in rpc_futures:
+      rpc_future.cancel()
+    raise
+
+
+@dataclasses.dataclass(frozen=True)
+class _SearchResult:
+  """The passing response found by _search_for_fmax_and_synth.
+
+  Only these scalars are kept, rather than the whole CompileResponse, so that
+  netlists are not held on to for the rest of the search.
+  """
+  max_frequency_hz: int
+  slack_ps: int
 
 
 def _search_for_fmax_and_synth(
-    stub: synthesis_service_pb2_grpc.SynthesisServiceStub,
+    stub: _Stub,
     verilog_text: str,
     top_module_name: str,
-) -> synthesis_pb2.CompileResponse:
-  """Bisects the space of frequencies and sends requests to the server."""
-  best_result = synthesis_pb2.CompileResponse()
+) -> _SearchResult:
+  """Searches the space of frequencies and sends requests to the server.
+
+  Each round probes --probes_per_round evenly spaced frequencies in the current
+  range at once. The range is then narrowed to lie between the highest passing
+  probe and the lowest failing probe above it; with a single probe per round
+  this is plain bisection. The search stops early once a probe has passed and
+  the fmax reported by the server agrees with the previous round's.
+  """
+  best_max_frequency_hz = 0
+  best_slack_ps = 0
   high_hz = _MAX_FREQ_MHZ.value * 1e6
   low_hz = _MIN_FREQ_MHZ.value * 1e6
   epsilon_hz = 2 * 1e6
+  num_probes = _PROBES_PER_ROUND.value
+  previous_max_hz = None
+  # Identifies the module in debug logs without dumping all of its text.
+  module_hash = (hashlib.sha256(verilog_text.encode()).hexdigest()
+                 if logging.vlog_is_on(3) else '')
 
   while (high_hz - low_hz) > epsilon_hz:
-    current_hz = (high_hz + low_hz) / 2
-    request = synthesis_pb2.CompileRequest()
-    request.target_frequency_hz = int(current_hz)
-    request.module_text = verilog_text
-    request.top_module_name = top_module_name
-    logging.vlog(3, '--- Debug')
-    logging.vlog(3, high_hz)
-    logging.vlog(3, low_hz)
-    logging.vlog(3, epsilon_hz)
-    logging.vlog(3, current_hz)
-    logging.vlog(3, '--- Request')
-    logging.vlog(3, request)
-    response = stub.Compile(request)
-    logging.vlog(3, '--- response')
-    logging.vlog(3, response.slack_ps)
-    logging.vlog(3, response.max_frequency_hz)
-    logging.vlog(3, response.netlist)
-
-    if response.slack_ps >= 0:
-      if response.max_frequency_hz:
-        logging.info(
-            'PASS at %.1fps (slack %dps @min %dps)',
-            1e12 / current_hz,
-            response.slack_ps,
-            1e12 / response.max_frequency_hz,
-        )
+    step_hz = (high_hz - low_hz) / (num_probes + 1)
+    probe_hzs = [low_hz + step_hz * (i + 1) for i in range(num_probes)]
+    requests = []
+    for current_hz in probe_hzs:
+      request = synthesis_pb2.CompileRequest()
+      request.target_frequency_hz = int(current_hz)
+      request.module_text = verilog_text
+      request.top_module_name = top_module_name
+      requests.append(request)
+    if logging.vlog_is_on(3):
+      logging.vlog(3, '--- Requests for %s (module sha256 %s)',
+                   top_module_name, module_hash)
+      logging.vlog(3, 'range [%d, %d] Hz, epsilon %d Hz, probes %s Hz',
+                   low_hz, high_hz, epsilon_hz,
+                   [request.target_frequency_hz for request in requests])
+    responses = _compile_all(stub, requests)
+
+    # The highest passing probe and the lowest failing probe above it; probes
+    # outside of that window are dominated and ignored.
+    passing = None
+    failing = None
+    for current_hz, request, response in zip(probe_hzs, requests, responses):
+      if logging.vlog_is_on(3):
+        logging.vlog(3, '--- Response at %d Hz: slack %dps, max %d Hz',
+                     request.target_frequency_hz, response.slack_ps,
+                     response.max_frequency_hz)
+
+      if response.slack_ps >= 0:
+        if response.max_frequency_hz:
+          logging.info(
+              'PASS at %.1fps (slack %dps @min %dps)',
+              1e12 / current_hz,
+              response.slack_ps,
+              1e12 / response.max_frequency_hz,
+          )
+        else:
+          logging.error('PASS but no maximum frequency determined.')
+          logging.error('ERROR: this occurs when '
+                        'an operator is optimized to a constant.')
+          logging.error('Source Verilog:\n%s', request.module_text)
+          sys.exit()
+        passing = (current_hz, response)
+        failing = None
       else:
-        logging.error('PASS but no maximum frequency determined.')
-        logging.error('ERROR: this occurs when '
-                      'an operator is optimized to a constant.')
-        logging.error('Source Verilog:\n%s', request.module_text)
-        sys.exit()
+        if response.max_frequency_hz:
+          logging.info(
+              'FAIL at %.1fps (slack %dps @min %dps).',
+              1e12 / current_hz,
+              response.slack_ps,
+              1e12 / response.max_frequency_hz,
+          )
+        else:
+          # This shouldn't happen
+          logging.info('FAIL but no maximum frequency provided')
+        if failing is None:
+          failing = (current_hz, response)
+
+    if passing is not None:
+      current_hz, response = passing
       low_hz = current_hz
-      if current_hz >= best_result.max_frequency_hz:
-        best_result = response
-    else:
-      if response.max_frequency_hz:
-        logging.info(
-            'FAIL at %.1fps (slack %dps @min %dps).',
-            1e12 / current_hz,
-            response.slack_ps,
-            1e12 / response.max_frequency_hz,
-        )
-      else:
-        # This shouldn't happen
-        logging.info('FAIL but no maximum frequency provided')
+      if current_hz >= best_max_frequency_hz:
+        best_max_frequency_hz = response.max_frequency_hz
+        best_slack_ps = response.slack_ps
+
+    if failing is not None:
+      current_hz, response = failing
       # Speed things up based on response
       if current_hz > (response.max_frequency_hz * 1.5):
         high_hz = response.max_frequency_hz * 1.1
@@ -135,144 +614,278 @@ def _search_for_fmax_and_synth(
       # This is necessary when the "speed up" code above narrows the range,
       # but then Yosys changes its expected fmax to be less than low_hz.
       #  ** This shouldn't happen any more **
-      if (not best_result.max_frequency_hz and
+      if (not best_max_frequency_hz and
           response.max_frequency_hz < low_hz):
         logging.info('PANIC!  Resetting search range.')
         high_hz = response.max_frequency_hz * 1.1
         low_hz = response.max_frequency_hz * 0.89
         current_hz = low_hz
 
-  if best_result.max_frequency_hz:
+    # Every response carries the server's own fmax estimate. Once a probe has
+    # passed and that estimate is stable across rounds, further probes would
+    # not change the result.
+    if passing is not None:
+      _, round_response = passing
+    else:
+      # Every probe either passes or fails, and there is at least one.
+      assert failing is not None
+      _, round_response = failing
+    if (best_max_frequency_hz and previous_max_hz is not None and
+        abs(round_response.max_frequency_hz - previous_max_hz) < epsilon_hz):
+      logging.info('Reported fmax converged at %dps.',
+                   1e12 / round_response.max_frequency_hz)
+      break
+    previous_max_hz = round_response.max_frequency_hz
+
+  if best_max_frequency_hz:
     logging.info(
         'Done at slack %dps @min %dps.',
-        best_result.slack_ps,
-        1e12 / best_result.max_frequency_hz,
+        best_slack_ps,
+        1e12 / best_max_frequency_hz,
     )
   else:
     logging.error(
         'INTERNAL ERROR: no passing run.'
     )
     sys.exit()
-  return best_result
-
-
-def _synthesize_ir(stub: synthesis_service_pb2_grpc.SynthesisServiceStub,
-                   results: delay_model_pb2.DataPoints,
-                   data_points: Dict[str, Set[str]], ir_text: str,
-                   op: str, result_bit_count: int,
-                   operand_bit_counts: Sequence[int],
-                   operand_element_counts: Dict[int, int],
-                   specialization: delay_model_pb2.SpecializationKind) -> None:
-  """Synthesizes the given IR text and checkpoint resulting data points."""
-  if op not in data_points:
-    data_points[op] = set()
-
-  bit_count_strs = []
-  for bit_count in operand_bit_counts:
-    operand = delay_model_pb2.Operation.Operand(
-        bit_count=bit_count, element_count=0
-    )
-    bit_count_strs.append(str(operand))
-  key = ', '.join([str(result_bit_count)] + bit_count_strs)
-  if specialization:
-    key = key + ' ' + str(specialization)
-  if key in data_points[op]:
-    return
-  data_points[op].add(key)
-
-  logging.info('Running %s with %d / %s', op, result_bit_count,
-               ', '.join([str(x) for x in operand_bit_counts]))
-  module_name = 'top'
+  return _SearchResult(best_max_frequency_hz, best_slack_ps)
+
+
+@dataclasses.dataclass
+class _Job:
+  """A generated op module waiting for its fmax to be determined."""
+  op: str
+  result_bit_count: int
+  operand_bit_counts: Sequence[int]
+  operand_element_counts: Dict[int, int]
+  specialization: delay_model_pb2.SpecializationKind
+  verilog_text: str
+  verilog_hash: bytes
+
+
+@functools.lru_cache(maxsize=4096)
+def _generate_ir_package(op_name: str, res_type: str,
+                         opnd_types: Tuple[str, ...],
+                         attr: Tuple[Tuple[str, str], ...],
+                         literal_operand: Optional[int],
+                         repeated_operand: Optional[int]) -> str:
+  """Memoized op_module_generator.generate_ir_package."""
+  # Imported on first use: op_module_generator pulls in the IR and codegen
+  # libraries, which processes that only load or print results don't need.
+  # pylint: disable-next=g-import-not-at-top
+  from xls.delay_model import op_module_generator
+  return op_module_generator.generate_ir_package(
+      op_name, res_type, list(opnd_types), attr, literal_operand,
+      repeated_operand)
+
+
+@functools.lru_cache(maxsize=4096)
+def _generate_verilog_module(ir_text: str) -> Tuple[str, bytes]:
+  """Returns the Verilog text generated for 'ir_text' and its sha256."""
+  # pylint: disable-next=g-import-not-at-top
+  from xls.delay_model import op_module_generator
   mod_generator_result = op_module_generator.generate_verilog_module(
-      module_name, ir_text)
+      _TOP_MODULE_NAME, ir_text)
+  verilog_text = mod_generator_result.verilog_text
+  return verilog_text, hashlib.sha256(verilog_text.encode()).digest()
 
-  op_comment = '// op: ' + op + ' \n'
-  verilog_text = op_comment + mod_generator_result.verilog_text
 
-  result = _search_for_fmax_and_synth(stub, verilog_text, module_name)
-  logging.vlog(3, 'Result: %s', result)
+def _ir_type(bit_count: int, element_counts: Sequence[int]) -> str:
+  """Returns e.g. 'bits[8][4][2]' for an IR bits or (nested) array type."""
+  return 'bits[%d]%s' % (bit_count, ''.join('[%d]' % c for c in element_counts))
 
-  if result.max_frequency_hz > 0:
-    ps = 1e12 / result.max_frequency_hz
-  else:
-    ps = 0
 
-  # Add a new record to the results proto
-  result_dp = results.data_points.add()
-  result_dp.operation.op = op
-  result_dp.operation.bit_count = result_bit_count
-  if specialization:
-    result_dp.operation.specialization = specialization
-  for bit_count in operand_bit_counts:
-    operand = result_dp.operation.operands.add(bit_count=bit_count)
-  for opnd_num, element_count in operand_element_counts.items():
-    result_dp.operation.operands[opnd_num].element_count = element_count
-  result_dp.delay = int(ps)
-  # TODO(tcal) currently no support for array result type here
+def _parse_attributes(attributes: str) -> Tuple[Tuple[str, str], ...]:
+  """Splits an OpSamples attribute string (at most one key/value pair).
 
-  # Checkpoint after every run.
-  save_checkpoint(results, _CHECKPOINT_PATH.value)
+  The value may still contain the '%r' result width placeholder.
+  """
+  if not attributes:
+    return ()
+  k, v = attributes.split('=')
+  return ((k, v),)
 
 
-def _run_point(
+def _prepare_job(
     op_samples: delay_model_pb2.OpSamples,
+    op_name: str,
+    attr_template: Tuple[Tuple[str, str], ...],
     point: delay_model_pb2.Parameterization,
-    results: delay_model_pb2.DataPoints,
-    data_points: Dict[str, Set[str]],
-    stub: synthesis_service_pb2_grpc.SynthesisServiceStub,
-) -> None:
-  """Generate IR and Verilog, run synthesis for one op parameterization."""
+    data_points: Dict[str, Set[_DataPointKey]],
+    lock: threading.Lock,
+) -> Optional[_Job]:
+  """Generate IR and Verilog for one op parameterization.
+
+  'attr_template' is the op's attributes as split by _parse_attributes.
+  Returns None if the parameterization has already been characterized (or
+  claimed by an earlier job); otherwise claims it in 'data_points'.
+  """
 
   op = op_samples.op
   specialization = op_samples.specialization
-  attributes = op_samples.attributes
 
-  op_name = ENUM2NAME_MAP[op]
+  res_bit_count = point.result_width
+  operand_bit_counts = point.operand_widths
+  key = (res_bit_count, tuple(operand_bit_counts), specialization)
+  with lock:
+    if op not in data_points:
+      data_points[op] = set()
+    if key in data_points[op]:
+      return None
+    data_points[op].add(key)
 
   # Result type - bitwidth and optionally element count(s)
-  res_bit_count = point.result_width
-  res_type = f'bits[{res_bit_count}]'
-  for res_elem in point.result_element_counts:
-    res_type += f'[{res_elem}]'
+  res_type = _ir_type(res_bit_count, point.result_element_counts)
 
   # Operand types - bitwidth and optionally element count(s)
-  opnd_element_counts: Dict[int, int] = {}
-  opnd_types = []
-  for bw in point.operand_widths:
-    opnd_types.append(f'bits[{bw}]')
+  opnd_dims: Dict[int, List[int]] = {}
   for opnd_elements in point.operand_element_counts:
-    tot_elems = 1
-    for count in opnd_elements.element_counts:
-      opnd_types[opnd_elements.operand_number] += f'[{count}]'
-      tot_elems *= count
-    opnd_element_counts[opnd_elements.operand_number] = tot_elems
-
-  # Handle attribute string (at most one key/value pair)
-  if attributes:
-    k, v = attributes.split('=')
-    v = v.replace('%r', str(res_bit_count))
-    attr = ((k, v),)
-  else:
-    attr = ()
+    opnd_dims.setdefault(opnd_elements.operand_number,
+                         []).extend(opnd_elements.element_counts)
+  opnd_types = [
+      _ir_type(bw, opnd_dims.get(opnd_num, ()))
+      for opnd_num, bw in enumerate(operand_bit_counts)
+  ]
+  opnd_element_counts: Dict[int, int] = {
+      opnd_num: math.prod(dims) for opnd_num, dims in opnd_dims.items()
+  }
+
+  # Substitute the result width into the attribute value, if it asks for it
+  attr = attr_template
+  if attr and '%r' in attr[0][1]:
+    k, v = attr[0]
+    attr = ((k, v.replace('%r', str(res_bit_count))),)
 
   # TODO(tcal): complete handling for specialization == HAS_LITERAL_OPERAND
   logging.info('types: %s : %s', res_type, ' '.join(opnd_types))
   literal_operand = None
   repeated_operand = 1 if (
       specialization == delay_model_pb2.OPERANDS_IDENTICAL) else None
-  ir_text = op_module_generator.generate_ir_package(
-      op_name, res_type, (opnd_types), attr, literal_operand, repeated_operand
+  ir_text = _generate_ir_package(
+      op_name, res_type, tuple(opnd_types), attr, literal_operand,
+      repeated_operand
   )
   logging.info('ir_text:\n%s\n', ir_text)
-  _synthesize_ir(
-      stub, results, data_points, ir_text, op, res_bit_count,
-      list(point.operand_widths), opnd_element_counts, specialization
-  )
+
+  verilog_text, verilog_hash = _generate_verilog_module(ir_text)
+  return _Job(op, res_bit_count, operand_bit_counts, opnd_element_counts,
+              specialization, verilog_text, verilog_hash)
+
+
+def _run_job(stub: _Stub, job: _Job, fmax_cache: Dict[bytes, int],
+             lock: threading.Lock) -> int:
+  """Returns the fmax of the job's module, searching for it if not known.
+
+  'fmax_cache' maps the sha256 of generated Verilog (without the op comment)
+  to the fmax found for it, so identical modules are only searched once.
+  """
+  logging.info('Running %s with %d / %s', job.op, job.result_bit_count,
+               ', '.join([str(x) for x in job.operand_bit_counts]))
+  with lock:
+    max_frequency_hz = fmax_cache.get(job.verilog_hash)
+  if max_frequency_hz is not None:
+    logging.info('Reusing fmax of identical Verilog: %d Hz', max_frequency_hz)
+    return max_frequency_hz
+
+  op_comment = '// op: ' + job.op + ' \n'
+  verilog_text = op_comment + job.verilog_text
+
+  result = _search_for_fmax_and_synth(stub, verilog_text, _TOP_MODULE_NAME)
+  if logging.vlog_is_on(3):
+    logging.vlog(3, 'Result: slack %dps, max %d Hz', result.slack_ps,
+                 result.max_frequency_hz)
+  with lock:
+    fmax_cache[job.verilog_hash] = result.max_frequency_hz
+  return result.max_frequency_hz
+
+
+def _record_result(checkpointer: _Checkpointer, lock: threading.Lock,
+                   job: _Job, max_frequency_hz: int) -> None:
+  """Adds the job's data point to the results and checkpoints them."""
+  if max_frequency_hz > 0:
+    ps = 1e12 / max_frequency_hz
+  else:
+    ps = 0
+
+  # Create a new record for the results proto
+  result_dp = delay_model_pb2.DataPoint()
+  result_dp.operation.op = job.op
+  result_dp.operation.bit_count = job.result_bit_count
+  if job.specialization:
+    result_dp.operation.specialization = job.specialization
+  for bit_count in job.operand_bit_counts:
+    operand = result_dp.operation.operands.add(bit_count=bit_count)
+  for opnd_num, element_count in job.operand_element_counts.items():
+    result_dp.operation.operands[opnd_num].element_count = element_count
+  result_dp.delay = int(ps)
+  # TODO(tcal) currently no support for array result type here
+
+  # Logged to the checkpoint now; the checkpoint itself is only rewritten every
+  # --checkpoint_compaction_interval data points.
+  with lock:
+    checkpointer.add(result_dp)
+
+
+def _put_unless_aborted(job_queue: queue.Queue, item: Optional[_Job],
+                        abort: threading.Event) -> None:
+  while not abort.is_set():
+    try:
+      job_queue.put(item, timeout=1)
+      return
+    except queue.Full:
+      pass
+
+
+def _produce_jobs(op_samples_list: delay_model_pb2.OpSamplesList,
+                  data_points: Dict[str, Set[_DataPointKey]],
+                  lock: threading.Lock, job_queue: queue.Queue,
+                  num_consumers: int, abort: threading.Event) -> None:
+  """Prepares a job for every sample point, then one None per consumer."""
+  try:
+    for op_samples in op_samples_list.op_samples:
+      op_name = ENUM2NAME_MAP[op_samples.op]
+      attr_template = _parse_attributes(op_samples.attributes)
+      for point in op_samples.samples:
+        if abort.is_set():
+          return
+        job = _prepare_job(op_samples, op_name, attr_template, point,
+                           data_points, lock)
+        if job is not None:
+          _put_unless_aborted(job_queue, job, abort)
+    for _ in range(num_consumers):
+      _put_unless_aborted(job_queue, None, abort)
+  except BaseException:
+    abort.set()
+    raise
+
+
+def _consume_jobs(stub: _Stub, checkpointer: _Checkpointer,
+                  fmax_cache: Dict[bytes, int], lock: threading.Lock,
+                  job_queue: queue.Queue, abort: threading.Event) -> None:
+  """Runs jobs from 'job_queue' until it yields None or the run is aborted."""
+  try:
+    while not abort.is_set():
+      try:
+        job = job_queue.get(timeout=1)
+      except queue.Empty:
+        continue
+      if job is None:
+        return
+      max_frequency_hz = _run_job(stub, job, fmax_cache, lock)
+      _record_result(checkpointer, lock, job, max_frequency_hz)
+  except BaseException:
+    abort.set()
+    raise
+
+
+def _data_point_key(operation: delay_model_pb2.Operation) -> _DataPointKey:
+  return (operation.bit_count, tuple(x.bit_count for x in operation.operands),
+          operation.specialization)
 
 
 def init_data(
     checkpoint_path: str
-) -> Tuple[Dict[str, Set[str]], delay_model_pb2.DataPoints]:
+) -> Tuple[Dict[str, Set[_DataPointKey]], delay_model_pb2.DataPoints]:
   """Return new state, loading data from a checkpoint, if available."""
   data_points = {}
   results = delay_model_pb2.DataPoints()
@@ -280,29 +893,68 @@ def init_data(
     filesystem.parse_text_proto_file(checkpoint_path, results)
     for data_point in results.data_points:
       op = data_point.operation
-      if op.op not in data_points:
-        data_points[op.op] = set()
-      key = ', '.join([str(op.bit_count)] +
-                      [str(x.bit_count) for x in op.operands])
-      if op.specialization:
-        key = key + ' ' + str(op.specialization)
-      data_points[op.op].add(key)
+      data_points.setdefault(op.op, set()).add(_data_point_key(op))
+    # Replay data points logged since the checkpoint was last written. The
+    # log may overlap the checkpoint if a run stopped while compacting.
+    for data_point in _read_checkpoint_log(checkpoint_path):
+      op = data_point.operation
+      op_data_points = data_points.setdefault(op.op, set())
+      key = _data_point_key(op)
+      if key not in op_data_points:
+        op_data_points.add(key)
+        results.data_points.append(data_point)
   return data_points, results
 
 
 def run_characterization(
     stub: synthesis_service_pb2_grpc.SynthesisServiceStub,
 ) -> None:
-  """Run characterization with the given synthesis service."""
+  """Run characterization with the given synthesis service.
+
+  A producer thread generates IR and Verilog for upcoming sample points while
+  --max_workers consumer threads run the fmax searches. All calls share the
+  stub's channel, which should come from make_channel() and stay open for the
+  whole run.
+  """
   data_points, data_points_proto = init_data(_CHECKPOINT_PATH.value)
   samples_file = _SAMPLES_PATH.value
   op_samples_list = delay_model_pb2.OpSamplesList()
   filesystem.parse_text_proto_file(samples_file, op_samples_list)
-  for op_samples in op_samples_list.op_samples:
-    for point in op_samples.samples:
-      _run_point(op_samples,
-                 point,
-                 data_points_proto, data_points, stub)
+  lock = threading.Lock()
+  # Only valid for this run's server and frequency range.
+  fmax_cache: Dict[bytes, int] = {}
+  num_workers = _MAX_WORKERS.value
+  job_queue = queue.Queue(maxsize=2 * num_workers)
+  # Set by any thread that fails (or is interrupted), so that the others stop
+  # promptly.
+  abort = threading.Event()
+  checkpointer = _Checkpointer(data_points_proto, _CHECKPOINT_PATH.value,
+                              _CHECKPOINT_COMPACTION_INTERVAL.value)
+  worker_stub = _CachingStub(
+      _StreamingStub(stub) if _USE_COMPILE_STREAM.value else stub,
+      _COMPILE_CACHE_PATH.value)
+  try:
+    with futures.ThreadPoolExecutor(max_workers=num_workers + 1) as executor:
+      thread_futures = [
+          executor.submit(_produce_jobs, op_samples_list, data_points, lock,
+                          job_queue, num_workers, abort)
+      ]
+      for _ in range(num_workers):
+        thread_futures.append(
+            executor.submit(_consume_jobs, worker_stub, checkpointer,
+                            fmax_cache, lock, job_queue, abort))
+      try:
+        # Surface the first failure (including sys.exit() from a worker).
+        for thread_future in thread_futures:
+          thread_future.result()
+      except BaseException:
+        # Also stop the workers on a failure in this thread, e.g. Ctrl-C, as
+        # the executor waits for them before re-raising it.
+        abort.set()
+        raise
+  finally:
+    worker_stub.close()
+    checkpointer.compact()
 
   print('# proto-file: xls/delay_model/delay_model.proto')
   print('# proto-message: xls.delay_model.DataPoints')
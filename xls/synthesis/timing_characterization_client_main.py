@@ -37,7 +37,8 @@ def main(argv):
     raise app.UsageError('Unexpected arguments.')
 
   channel_creds = client_credentials.get_credentials()
-  with grpc.secure_channel(f'localhost:{FLAGS.port}', channel_creds) as channel:
+  with client.make_channel(f'localhost:{FLAGS.port}',
+                           channel_creds) as channel:
     grpc.channel_ready_future(channel).result()
     stub = synthesis_service_pb2_grpc.SynthesisServiceStub(channel)
 
@@ -15,13 +15,70 @@
 """Tests for xls.synthesis.timing_characterization_client_main."""
 
 import collections
+from concurrent import futures
+import struct
 import tempfile
 
 from absl.testing import absltest
+from absl.testing import flagsaver
 from xls.delay_model import delay_model_pb2
+from xls.synthesis import synthesis_pb2
 from xls.synthesis import timing_characterization_client as client
 
 
+class _EchoStub:
+  """Fake SynthesisServiceStub answering with the request's frequency."""
+
+  def __init__(self):
+    self.num_streams = 0
+
+  # pylint: disable-next=invalid-name
+  def CompileStream(self, request_iterator, **kwargs):
+    del kwargs  # Unused.
+    self.num_streams += 1
+    return self._respond(request_iterator)
+
+  def _respond(self, request_iterator):
+    for request in request_iterator:
+      yield synthesis_pb2.CompileResponse(
+          max_frequency_hz=request.target_frequency_hz)
+
+
+class _UnaryMethod:
+  """Fake unary-unary multi-callable supporting blocking and future calls."""
+
+  def __init__(self, handler):
+    self._handler = handler
+
+  def __call__(self, request, **kwargs):
+    del kwargs  # Unused.
+    return self._handler(request)
+
+  def future(self, request, **kwargs):
+    del kwargs  # Unused.
+    rpc_future = futures.Future()
+    rpc_future.set_result(self._handler(request))
+    return rpc_future
+
+
+class _FixedFmaxStub:
+  """Fake SynthesisServiceStub for a design which closes timing at fmax."""
+
+  def __init__(self, max_frequency_hz, netlist=""):
+    self._max_frequency_hz = max_frequency_hz
+    self._netlist = netlist
+    self.num_requests = 0
+    self.Compile = _UnaryMethod(self._compile)  # pylint: disable=invalid-name
+
+  def _compile(self, request):
+    self.num_requests += 1
+    return synthesis_pb2.CompileResponse(
+        slack_ps=int(1e12 / request.target_frequency_hz -
+                     1e12 / self._max_frequency_hz),
+        max_frequency_hz=self._max_frequency_hz,
+        netlist=self._netlist)
+
+
 class TimingCharacterizationClientMainTest(absltest.TestCase):
 
   def test_save_load_checkpoint(self):
@@ -32,18 +89,22 @@ class TimingCharacterizationClientMainTest(absltest.TestCase):
 
     # Set up some dummy data.
     ops = ["op_a", "op_b", "op_c", "op_d", "op_e"]
-    bit_configs = ["3, 1, 1", "4, 1, 2", "5, 2, 1", "6, 2, 2"]
+    bit_configs = [(3, (1, 1), 0), (4, (1, 2), 0), (5, (2, 1), 0),
+                   (6, (2, 2), delay_model_pb2.OPERANDS_IDENTICAL)]
     for op in ops:
       data_points[op] = set()
       for bit_config in bit_configs:
         data_points[op].add(bit_config)
+        result_bit_count, operand_bit_counts, specialization = bit_config
         result = delay_model_pb2.DataPoint()
         result.operation.op = op
-        for elem in bit_config.split(",")[1:]:
+        for bit_count in operand_bit_counts:
           operand = delay_model_pb2.Operation.Operand()
-          operand.bit_count = int(elem)
+          operand.bit_count = bit_count
           result.operation.operands.append(operand)
-        result.operation.bit_count = int(bit_config[0])
+        result.operation.bit_count = result_bit_count
+        if specialization:
+          result.operation.specialization = specialization
         result.delay = 5
         results.data_points.append(result)
     tf = tempfile.NamedTemporaryFile()
@@ -61,6 +122,206 @@ class TimingCharacterizationClientMainTest(absltest.TestCase):
         self.assertIn(bit_config, data_points[op])
     self.assertEqual(data_points, loaded_data_points)
 
+  def test_streaming_stub_matches_responses_in_order(self):
+    stub = client._StreamingStub(_EchoStub())
+    try:
+      for hz in [100, 300, 200]:
+        request = synthesis_pb2.CompileRequest(target_frequency_hz=hz)
+        self.assertEqual(stub.Compile(request).max_frequency_hz, hz)
+    finally:
+      stub.close()
+
+  def test_streaming_stub_compiles_batch_on_separate_streams(self):
+    echo_stub = _EchoStub()
+    stub = client._StreamingStub(echo_stub)
+    try:
+      for hzs in [[100, 300, 200], [400, 500]]:
+        requests = [
+            synthesis_pb2.CompileRequest(target_frequency_hz=hz) for hz in hzs
+        ]
+        self.assertEqual(
+            [response.max_frequency_hz
+             for response in stub.compile_all(requests)], hzs)
+      # The streams opened for the first batch are reused for the second.
+      self.assertEqual(echo_stub.num_streams, 3)
+    finally:
+      stub.close()
+
+  def test_search_for_fmax_with_parallel_probes(self):
+    for probes in [1, 4]:
+      with self.subTest(probes=probes), flagsaver.flagsaver(
+          probes_per_round=probes):
+        stub = _FixedFmaxStub(1_000_000_000)
+        result = client._search_for_fmax_and_synth(stub, "module top;", "top")
+        self.assertEqual(result.max_frequency_hz, 1_000_000_000)
+        self.assertGreaterEqual(result.slack_ps, 0)
+        # The server reports the same fmax every time, so the search stops
+        # after the round following the first one that passes.
+        self.assertLessEqual(stub.num_requests, 2 * probes)
+
+  def test_caching_stub_persists_responses(self):
+    cache_file = self.create_tempfile()
+    requests = [
+        synthesis_pb2.CompileRequest(
+            module_text="module top;", top_module_name="top",
+            target_frequency_hz=hz) for hz in [100, 200]
+    ]
+    stub = _FixedFmaxStub(150)
+    caching_stub = client._CachingStub(stub, cache_file.full_path)
+    first_responses = caching_stub.compile_all(requests)
+    caching_stub.close()
+    self.assertEqual(stub.num_requests, 2)
+
+    # A fresh cache on the same file answers without reaching the server.
+    caching_stub = client._CachingStub(stub, cache_file.full_path)
+    self.assertEqual(caching_stub.compile_all(requests), first_responses)
+    caching_stub.close()
+    self.assertEqual(stub.num_requests, 2)
+
+  def test_caching_stub_drops_netlist(self):
+    stub = _FixedFmaxStub(150, netlist="module top_netlist; endmodule")
+    caching_stub = client._CachingStub(stub, "")
+    request = synthesis_pb2.CompileRequest(
+        module_text="module top;", top_module_name="top",
+        target_frequency_hz=100)
+    for _ in range(2):
+      response = caching_stub.Compile(request)
+      self.assertEqual(response.max_frequency_hz, 150)
+      self.assertFalse(response.HasField("netlist"))
+    self.assertEqual(stub.num_requests, 1)
+
+  def test_checkpoint_log_is_replayed(self):
+    checkpoint_file = self.create_tempfile()
+    results = delay_model_pb2.DataPoints()
+    checkpointer = client._Checkpointer(
+        results, checkpoint_file.full_path, compaction_interval=3)
+    for bit_count in range(1, 6):
+      # Decreasing delays, so the delay offset changes with every data point.
+      data_point = delay_model_pb2.DataPoint(delay=10 - bit_count)
+      data_point.operation.op = "kAdd"
+      data_point.operation.bit_count = bit_count
+      data_point.operation.operands.add(bit_count=bit_count)
+      checkpointer.add(data_point)
+
+    # Three data points were compacted into the checkpoint; the last two are
+    # only in its log, each with the delay offset as of when it was added.
+    self.assertEqual([
+        dp.delay_offset
+        for dp in client._read_checkpoint_log(checkpoint_file.full_path)
+    ], [6, 5])
+    _, compacted_results = client.init_data(checkpoint_file.full_path)
+    self.assertLen(compacted_results.data_points, 5)
+    self.assertEqual(
+        [dp.operation.bit_count for dp in compacted_results.data_points],
+        [1, 2, 3, 4, 5])
+
+    checkpointer.compact()
+    self.assertEqual([dp.delay_offset for dp in results.data_points],
+                     [5] * 5)
+    loaded_data_points, loaded_results = client.init_data(
+        checkpoint_file.full_path)
+    self.assertEqual(results, loaded_results)
+    self.assertEqual(loaded_data_points,
+                     {"kAdd": {(b, (b,), 0) for b in range(1, 6)}})
+
+  def test_torn_checkpoint_log_record_is_dropped(self):
+    checkpoint_path = self.create_tempfile().full_path
+
+    def add_data_points(bit_counts):
+      _, results = client.init_data(checkpoint_path)
+      checkpointer = client._Checkpointer(
+          results, checkpoint_path, compaction_interval=100)
+      for bit_count in bit_counts:
+        data_point = delay_model_pb2.DataPoint(delay=5)
+        data_point.operation.op = "kAdd"
+        data_point.operation.bit_count = bit_count
+        checkpointer.add(data_point)
+
+    add_data_points([1, 2])
+    # Simulate a run interrupted while appending a record to the log.
+    with open(client._checkpoint_log_path(checkpoint_path), "ab") as f:
+      f.write(struct.pack("<I", 100) + b"\x08")
+    add_data_points([3, 4])
+
+    data_points, results = client.init_data(checkpoint_path)
+    self.assertEqual(data_points,
+                     {"kAdd": {(b, (), 0) for b in range(1, 5)}})
+    self.assertLen(results.data_points, 4)
+
+  def test_checkpoint_log_of_replaced_checkpoint_is_ignored(self):
+    checkpoint_file = self.create_tempfile()
+    _, results = client.init_data(checkpoint_file.full_path)
+    checkpointer = client._Checkpointer(
+        results, checkpoint_file.full_path, compaction_interval=100)
+    data_point = delay_model_pb2.DataPoint(delay=5)
+    data_point.operation.op = "kAdd"
+    data_point.operation.bit_count = 1
+    checkpointer.add(data_point)
+    _, resumed_results = client.init_data(checkpoint_file.full_path)
+    self.assertLen(resumed_results.data_points, 1)
+
+    # Starting over from an empty checkpoint does not replay the log left by
+    # the killed run.
+    checkpoint_file.write_text("")
+    data_points, results = client.init_data(checkpoint_file.full_path)
+    self.assertEmpty(data_points)
+    self.assertEmpty(results.data_points)
+
+  def test_keepalive_is_off_by_default(self):
+    self.assertNotIn("grpc.keepalive_time_ms",
+                     dict(client._channel_options()))
+    with flagsaver.flagsaver(keepalive_time_ms=30000):
+      self.assertEqual(
+          dict(client._channel_options())["grpc.keepalive_time_ms"], 30000)
+
+  def test_run_characterization(self):
+    samples_file = self.create_tempfile(content="""
+        op_samples {
+          op: "kAdd"
+          samples { result_width: 8 operand_widths: 8 operand_widths: 8 }
+          samples { result_width: 16 operand_widths: 16 operand_widths: 16 }
+          samples { result_width: 8 operand_widths: 8 operand_widths: 8 }
+        }
+        """)
+    checkpoint_file = self.create_tempfile()
+    stub = _FixedFmaxStub(500_000_000)
+    with flagsaver.flagsaver(samples_path=samples_file.full_path,
+                             checkpoint_path=checkpoint_file.full_path,
+                             max_workers=2):
+      client.run_characterization(stub)
+      num_requests = stub.num_requests
+      # Every sample point is already in the checkpoint, so a second run
+      # sends no requests.
+      client.run_characterization(stub)
+    self.assertEqual(stub.num_requests, num_requests)
+
+    data_points, results = client.init_data(checkpoint_file.full_path)
+    # The repeated sample point is only characterized once.
+    self.assertEqual(data_points,
+                     {"kAdd": {(8, (8, 8), 0), (16, (16, 16), 0)}})
+    self.assertCountEqual(
+        [(dp.operation.bit_count, dp.delay, dp.delay_offset)
+         for dp in results.data_points], [(8, 2000, 2000), (16, 2000, 2000)])
+
+  def test_run_characterization_does_not_reuse_fmax_across_runs(self):
+    samples_file = self.create_tempfile(content="""
+        op_samples {
+          op: "kAdd"
+          samples { result_width: 8 operand_widths: 8 operand_widths: 8 }
+        }
+        """)
+    for max_frequency_hz, delay in [(500_000_000, 2000), (250_000_000, 4000)]:
+      checkpoint_file = self.create_tempfile()
+      stub = _FixedFmaxStub(max_frequency_hz)
+      with flagsaver.flagsaver(samples_path=samples_file.full_path,
+                               checkpoint_path=checkpoint_file.full_path):
+        client.run_characterization(stub)
+      # The identical module from the previous run is searched again on this
+      # run's server.
+      self.assertGreater(stub.num_requests, 0)
+      _, results = client.init_data(checkpoint_file.full_path)
+      self.assertEqual([dp.delay for dp in results.data_points], [delay])
+
 
 if __name__ == "__main__":
   absltest.main()
@@ -34,6 +34,7 @@
 #include "xls/synthesis/server_credentials.h"
 #include "xls/synthesis/synthesis.pb.h"
 #include "xls/synthesis/synthesis_service.grpc.pb.h"
+#include "xls/synthesis/synthesis_server_util.h"
 #include "xls/synthesis/yosys/yosys_util.h"
 
 const char kUsage[] =
@@ -103,6 +104,13 @@ class YosysSynthesisServiceImpl : public SynthesisService::Service {
     return ::grpc::Status::OK;
   }
 
+  ::grpc::Status CompileStream(
+      ::grpc::ServerContext* server_context,
+      ::grpc::ServerReaderWriter<CompileResponse, CompileRequest>* stream)
+      override {
+    return ServeCompileStream(this, server_context, stream);
+  }
+
   // Run the given arguments as a subprocess with InvokeSubprocess.
   // InvokeSubprocess is wrapped because the error message can be very large (it
   // includes both stdout and stderr) which breaks propagation of the error via
@@ -475,6 +483,7 @@ void RealMain() {
   ::grpc::ServerBuilder builder;
   std::shared_ptr<::grpc::ServerCredentials> creds = GetServerCredentials();
   builder.AddListeningPort(server_address, creds);
+  ConfigureServerBuilder(&builder);
   builder.RegisterService(&service);
   std::unique_ptr<::grpc::Server> server(builder.BuildAndStart());
   XLS_LOG(INFO) << "Serving on port: " << port;
@@ -293,9 +293,13 @@ def _do_worker_task(config: WorkerConfig):
   client_cmd = repr(' '.join(client))
   client_cmd = client_cmd.replace("'", '')
 
-  # create a checkpoint file if not allready there
+  # Start from an empty checkpoint, also dropping the checkpoint log of a
+  # client that was killed before it could fold the log into the checkpoint.
   with open(config.client_checkpoint_file, 'w') as f:
     f.write('')
+  checkpoint_log_file = config.client_checkpoint_file + '.log'
+  if os.path.exists(checkpoint_log_file):
+    os.remove(checkpoint_log_file)
 
   start = datetime.datetime.now()
 